@@ -1,11 +1,87 @@
-import random
+import functools
+import numpy as np
 
 # using lists instead of named vars to keep it short.
 CONFIG_mkB = {
     'seed': None,
     'means': [25, 40, 20, 40], # mean times of all stages: next/prep/op/rec
     'unif': [None, (20,20), None, None], #uniform dist. params. if None then use 'means' with expovar.
-    'total': [5,2,5], # useable + starting slack (unused/offline) capacity for each facility type.
+    'total': [5,2,5], # maximum useable capacity (staffed + unused/offline) for each facility type.
     'staffed': [3, 1, 3], # useable totals of each identical facility: prep/op/rec
-    'monitor_interval': 5 # snapshot interval for non-patient variables, such as queues
+    'monitor_interval': 5 # snapshot interval for non-patient variables, such as queues. None = no monitor process
 }
+
+# batched random draws: numpy fills a whole buffer in one call, processes take values from it one at a time.
+# draws are unit-scale, the mean/range is applied at draw time so config edits between run_for() calls still apply.
+# uses the counter-based Philox generator: seed is the key, state is just a counter, so streams are cheap and independent.
+class random_stream:
+
+    # first: already sampled first batch to start from, see _first_batch()
+    def __init__(self, seed=None, batch=4096, first=None):
+        self.batch = batch
+        if (first == None):
+            self.rng = np.random.Generator(np.random.Philox(seed)) # seed: int, None or SeedSequence
+            self.refill()
+            return
+        self.unif_buf, self.exp_buf, state = first
+        self.i = 0
+        bitgen = np.random.Philox()
+        bitgen.state = state # continue right after the cached batch
+        self.rng = np.random.Generator(bitgen)
+
+    # one batch of uniforms, exponentials are made from the same uniforms by vectorized inverse cdf.
+    # both distributions consume the same counter, so a stage keeps its draws aligned when switched between them.
+    # buffers are handed out as python floats: indexing a list and float math on the result is cheaper than numpy scalars.
+    def refill(self):
+        u = self.rng.random(self.batch)
+        self.unif_buf = u.tolist()
+        self.exp_buf = (-np.log1p(-u)).tolist() # unit exponential: -log(1-u)
+        self.i = 0
+
+    # exponential with given mean (not rate, unlike random.expovariate)
+    def expo(self, mean):
+        if self.i == self.batch: # buffer used up, refill
+            self.refill()
+        x = self.exp_buf[self.i]
+        self.i += 1
+        return mean * x
+
+    def unif(self, a, b):
+        if self.i == self.batch:
+            self.refill()
+        u = self.unif_buf[self.i]
+        self.i += 1
+        return a + (b - a) * u
+
+    # zero-argument draw function for one stage, with the distribution choice made here once instead of per draw.
+    # uniform if params are given, otherwise exponential with the mean.
+    def sampler(self, mean, unif):
+        if (unif != None):
+            return functools.partial(self.unif, unif[0], unif[1])
+        return functools.partial(self.expo, mean)
+
+    # next n uniforms as one array, continuing the same sequence that expo()/unif() draw from
+    def uniforms(self, n):
+        rest = self.unif_buf[self.i:]
+        if (n <= len(rest)):
+            self.i += n
+            return np.array(rest[:n])
+        out = np.concatenate((rest, self.rng.random(n - len(rest))))
+        self.refill()
+        return out
+
+# first batch of stream k for an int seed, kept across models: replications that reuse a seed
+# (common random numbers, e.g. comparing facility layouts) skip re-sampling it. shared between streams, so tuples.
+@functools.lru_cache(maxsize=64)
+def _first_batch(seed, k, batch):
+    rng = np.random.Generator(np.random.Philox(np.random.SeedSequence(seed, spawn_key=(k,)))) # same as spawn()[k]
+    u = rng.random(batch)
+    e = -np.log1p(-u)
+    return tuple(u.tolist()), tuple(e.tolist()), rng.bit_generator.state
+
+# one independent stream per sampled quantity: next/prep/op/rec, same order as 'means'.
+# each stage keeps its own counter, so changing one stage's distribution does not shift the draws of the others.
+def random_streams(seed, n=4, batch=4096):
+    if (isinstance(seed, int)):
+        return [random_stream(batch=batch, first=_first_batch(seed, k, batch)) for k in range(n)]
+    return [random_stream(s, batch) for s in np.random.SeedSequence(seed).spawn(n)]
@@ -0,0 +1,234 @@
+# -- file that contains the compiled event-list version of the surgery unit model --
+# same patient path as patient_mkB (prep -> op -> rec, a stage is held until the next one is free),
+# but scheduled with a plain array heap instead of simpy processes, so the whole run can be compiled with numba.
+# facility counts are fixed for the run, mid-sim config changes need the simpy hospital_model.
+
+import numpy as np
+from config import random_streams
+from hospital_model import FLOW_FIELDS, check_staffing
+
+try:
+    from numba import njit
+except ImportError: # numba not installed: same code runs as plain python, just slower
+    def njit(*args, **kwargs):
+        if (len(args) == 1 and callable(args[0])):
+            return args[0]
+        return lambda f: f
+
+# event kinds in the heap: stage done events are indexed by the stage that finished
+ARRIVAL, PREP_DONE, OP_DONE, REC_DONE = 0, 1, 2, 3
+
+# index of each value in the stats array returned by simulate()
+# util/total active for prep/op/rec, same meaning as in hospital_model.results, then or_time_blocked
+STATS_UTIL, STATS_TOTAL, STATS_BLOCKED = 0, 3, 6
+
+# heap of (time, seq, kind, patient) stored as parallel arrays, ordered by time then seq.
+# seq is the scheduling order, so same-time events run first-scheduled-first like in simpy.
+@njit(cache=True)
+def _earlier(ht, hs, a, b):
+    return ht[a] < ht[b] or (ht[a] == ht[b] and hs[a] < hs[b])
+
+@njit(cache=True)
+def _swap(ht, hs, hk, hp, a, b):
+    ht[a], ht[b] = ht[b], ht[a]
+    hs[a], hs[b] = hs[b], hs[a]
+    hk[a], hk[b] = hk[b], hk[a]
+    hp[a], hp[b] = hp[b], hp[a]
+
+@njit(cache=True)
+def _push(ht, hs, hk, hp, n, t, seq, kind, pid):
+    ht[n] = t
+    hs[n] = seq
+    hk[n] = kind
+    hp[n] = pid
+    i = n
+    while i > 0: # sift up
+        parent = (i - 1) // 2
+        if not _earlier(ht, hs, i, parent):
+            break
+        _swap(ht, hs, hk, hp, i, parent)
+        i = parent
+    return n + 1
+
+# removes the root, caller reads it before popping
+@njit(cache=True)
+def _pop(ht, hs, hk, hp, n):
+    n -= 1
+    _swap(ht, hs, hk, hp, 0, n)
+    i = 0
+    while True: # sift down
+        left = 2 * i + 1
+        if left >= n:
+            break
+        child = left
+        if left + 1 < n and _earlier(ht, hs, left + 1, left):
+            child = left + 1
+        if not _earlier(ht, hs, child, i):
+            break
+        _swap(ht, hs, hk, hp, i, child)
+        i = child
+    return n
+
+# run the model over pre-sampled times until sim time 'until'.
+# arrival: arrival time of each patient, sorted. prep_t/op_t/rec_t: required service times. caps: staffed prep/op/rec.
+# returns flow as (5, patients) columns arrival/prep/op/rec/leave per arrived patient, 0 = not reached,
+# stats (see STATS_*) and busy prep/op/rec
+# typed signature: compiled once for float64 times and int64 caps, and the compiled code is cached on disk.
+# no fastmath, it may reorder the float sums and then results would no longer match the simpy model exactly.
+@njit('Tuple((float64[:, :], float64[:], int64[:]))(float64[:], float64[:], float64[:], float64[:], int64[:], float64)',
+      cache=True)
+def simulate(arrival, prep_t, op_t, rec_t, caps, until):
+    n = arrival.shape[0]
+    service = (prep_t, op_t, rec_t)
+    flow = np.zeros((5, n)) # struct-of-arrays: one contiguous column per field, indexed by patient
+    stats = np.zeros(7)
+    done_at = np.zeros(n) # time the current stage finished, used for time blocked waiting for rec
+
+    # event heap: at most one pending arrival plus one pending service per patient
+    ht = np.empty(n + 1)
+    hs = np.empty(n + 1, dtype=np.int64)
+    hk = np.empty(n + 1, dtype=np.int64)
+    hp = np.empty(n + 1, dtype=np.int64)
+    hn = 0
+    seq = 0
+
+    # fifo queue per stage, each patient enters each queue at most once so no wrap-around needed
+    queue = np.empty((3, n), dtype=np.int64)
+    head = np.zeros(3, dtype=np.int64)
+    tail = np.zeros(3, dtype=np.int64)
+    busy = np.zeros(3, dtype=np.int64)
+
+    arrived = 0
+    free = caps[0] > 0 and caps[1] > 0 and caps[2] > 0 # every stage can take a patient at all
+    if (n > 0):
+        hn = _push(ht, hs, hk, hp, hn, arrival[0], seq, ARRIVAL, 0)
+        seq += 1
+
+    while hn > 0:
+        t = ht[0]
+        if (t >= until): # simpy run(until) does not process events at the end time either
+            break
+        kind = hk[0]
+        pid = hp[0]
+        hn = _pop(ht, hs, hk, hp, hn)
+
+        if (kind == ARRIVAL):
+            flow[0, pid] = t
+            arrived += 1
+            if (pid + 1 < n):
+                hn = _push(ht, hs, hk, hp, hn, arrival[pid + 1], seq, ARRIVAL, pid + 1)
+                seq += 1
+            # light load skip: empty unit and the next patient only arrives after this one has left,
+            # so nothing can interfere with this path. write it out directly instead of scheduling its 3 stages.
+            t_prep = t + prep_t[pid]
+            t_op = t_prep + op_t[pid]
+            t_leave = t_op + rec_t[pid]
+            if (free and busy[0] == 0 and busy[1] == 0 and busy[2] == 0 and t_leave < until
+                    and (pid + 1 >= n or arrival[pid + 1] > t_leave)):
+                flow[1, pid] = t
+                flow[2, pid] = t_prep
+                flow[3, pid] = t_op
+                flow[4, pid] = t_leave
+                for k in range(3):
+                    stats[STATS_UTIL + k] += service[k][pid]
+                # totals from the stage times like the normal path, t_prep - t does not give back prep_t exactly
+                stats[STATS_TOTAL + 0] += t_prep - t
+                stats[STATS_TOTAL + 1] += t_op - t_prep
+                stats[STATS_TOTAL + 2] += rec_t[pid]
+                continue
+            stage = 0
+        else:
+            stage = kind # prep/op done requests op/rec, rec done frees the rec bed
+            done = kind - 1
+            stats[STATS_UTIL + done] += service[done][pid]
+            done_at[pid] = t
+            if (kind == REC_DONE):
+                stats[STATS_TOTAL + 2] += rec_t[pid] # rec does not need to wait
+                flow[4, pid] = t
+
+        # request 'stage' for pid. a granted stage frees the previous one, which may let its queue move, and so on.
+        # stage 3 is leaving: nothing to request, only the rec bed is freed.
+        if (stage < 3 and (busy[stage] >= caps[stage] or head[stage] != tail[stage])):
+            queue[stage, tail[stage]] = pid
+            tail[stage] += 1
+            continue
+        while True:
+            if (stage < 3): # start stage for pid
+                busy[stage] += 1
+                flow[stage + 1, pid] = t
+                if (stage == 1):
+                    stats[STATS_TOTAL + 0] += t - flow[1, pid]
+                elif (stage == 2):
+                    stats[STATS_BLOCKED] += t - done_at[pid]
+                    stats[STATS_TOTAL + 1] += t - flow[2, pid]
+                hn = _push(ht, hs, hk, hp, hn, t + service[stage][pid], seq, stage + 1, pid)
+                seq += 1
+                if (stage == 0):
+                    break # prep start frees nothing
+            # pid left stage-1, hand the slot to the first in its queue
+            stage -= 1
+            busy[stage] -= 1
+            if (head[stage] == tail[stage] or busy[stage] >= caps[stage]):
+                break
+            pid = queue[stage, head[stage]]
+            head[stage] += 1
+
+    return flow[:, :arrived], stats, busy
+
+# sampled times for one stage: same stream and transform as random_stream.expo()/unif(), so the same seed
+# gives the same patients as the simpy model
+def _stage_times(stream, mean, unif, n):
+    u = stream.uniforms(n)
+    if (unif != None):
+        return unif[0] + (unif[1] - unif[0]) * u
+    return mean * -np.log1p(-u)
+
+# single-shot fast version of hospital_model, for long runs with a fixed facility config.
+# run() gives results in the same layout as hospital_model.results, minus snapshots (no monitor process).
+class hospital_model_fast:
+
+    def __init__(self,conf):
+        self.conf = conf
+        self.streams = random_streams(conf['seed'])
+        self.results = None
+        self.cols = None
+
+    def run(self, time):
+        if (time <= 0): # simpy run(until) rejects this too, and there would be no arrivals to sample
+            raise ValueError('run length must be positive, got %s' % time)
+        conf = self.conf
+        check_staffing(conf)
+        # enough arrivals to pass the end time, sampled in chunks
+        ia_chunks = []
+        last = 0.0
+        chunk = int(time / conf['means'][0] * 1.2) + 16
+        while last < time:
+            ia = _stage_times(self.streams[0], conf['means'][0], conf['unif'][0], chunk)
+            ia_chunks.append(ia)
+            last += ia.sum()
+        ia = np.concatenate(ia_chunks)
+        arrival = np.concatenate(([0.0], np.cumsum(ia)[:-1])) # first patient at time 0, like the generator
+        n = len(arrival)
+        prep_t, op_t, rec_t = [_stage_times(self.streams[k], conf['means'][k], conf['unif'][k], n) for k in (1, 2, 3)]
+        caps = np.array(conf['staffed'], dtype=np.int64)
+
+        cols, stats, busy = simulate(arrival, prep_t, op_t, rec_t, caps, float(time))
+        self.cols = np.ascontiguousarray(cols) # trimmed to arrived patients, keep only what is used
+        flow = self.cols.T
+        left = int(np.count_nonzero(self.cols[4]))
+        self.results = {
+            'patient_flow': flow, # (patients, 5) view of the columns: arrival/prep/op/rec/leave
+            'patient_counts': [len(flow) - left, int(busy[0]), int(busy[1]), int(busy[2])],
+            'total_active': list(stats[STATS_TOTAL:STATS_TOTAL + 3]),
+            'util_active': list(stats[STATS_UTIL:STATS_UTIL + 3]),
+            'snapshots': [],
+            'or_time_blocked': float(stats[STATS_BLOCKED])
+        }
+        return self.results
+
+    # same analysis helpers as hospital_model, the columns come straight from the core without conversion
+    def flow_table(self):
+        return self.results['patient_flow']
+
+    def flow_arrays(self):
+        return {name: self.cols[i] for i, name in enumerate(FLOW_FIELDS)}
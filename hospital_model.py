@@ -1,32 +1,93 @@
 # -- file that contains process function definitions --
 
-import random
 import simpy
 import copy
+import itertools
+import os
+import numpy as np
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from config import random_streams
 
-# generator starts new patient process according to interval distribution
-def patient_generator_mkB(env,conf,resu,facilities):
-    while True:
-        env.process(patient_mkB(env,conf,resu,facilities))
-        t_out = random.expovariate(1/conf['means'][0])
-        if (conf['unif'][0] != None):
-            t_out = random.uniform(conf['unif'][0][0],conf['unif'][0][1])
-        yield env.timeout(t_out)
+# column names of a patient_flow record, in order
+FLOW_FIELDS = ('arrival', 'prep', 'op', 'rec', 'leave')
+
+# fifo resource for identical facilities, used like simpy.Resource: request()/release()/queue/count.
+# a free facility is granted without scheduling anything: request() returns an already processed event,
+# so the yielding process just continues. waiters are kept in a deque, handing a slot to the next is O(1).
+class fast_resource:
+
+    def __init__(self, env, capacity):
+        self.env = env
+        self.capacity = capacity
+        self.count = 0 # facilities in use
+        self.queue = deque() # waiting request events, first come first served
+        # shared 'already processed' event, simpy resumes a process at once when it yields one of these
+        self._granted = env.event()
+        self._granted._ok = True
+        self._granted._value = None
+        self._granted.callbacks = None
+
+    def request(self):
+        if (self.count < self.capacity and not self.queue):
+            self.count += 1
+            return self._granted
+        req = self.env.event()
+        self.queue.append(req)
+        return req
+
+    # change the number of usable facilities. patients already in a facility keep it,
+    # if it went up the extra facilities go to the queue right away.
+    def set_capacity(self, capacity):
+        self.capacity = capacity
+        queue = self.queue
+        while (queue and self.count < capacity):
+            self.count += 1
+            queue.popleft().succeed()
+
+    def release(self, req):
+        if (not req.triggered): # never granted, only leaves the queue
+            self.queue.remove(req)
+            return
+        if (self.queue and self.count <= self.capacity):
+            self.queue.popleft().succeed() # facility goes straight to the next in line, count unchanged
+        else:
+            self.count -= 1
+
+# patient counts total/prep/op/rec packed into one int, so a stage transition is a single add.
+# prep/op/rec get 16 bits each (bounded by facility counts), total sits on top and can grow freely.
+COUNT_PREP, COUNT_OP, COUNT_REC, COUNT_TOTAL = 1, 1 << 16, 1 << 32, 1 << 48
+COUNT_PREP_TO_OP = COUNT_OP - COUNT_PREP
+COUNT_OP_TO_REC = COUNT_REC - COUNT_OP
+COUNT_LEAVE = -COUNT_REC - COUNT_TOTAL
+
+# packed counts back to (total, prep, op, rec)
+def unpack_counts(packed):
+    return (packed >> 48, packed & 0xFFFF, (packed >> 16) & 0xFFFF, (packed >> 32) & 0xFFFF)
+
+# starts new patient processes according to interval distribution.
+# arrivals are a chain of timeout callbacks rather than a generator process: each arrival schedules the next one,
+# so there is no process to resume in between.
+def patient_generator_mkB(env,samplers,resu,facilities):
+    process = env.process # bound once, called for every arrival
+    timeout = env.timeout
+    def arrive(event):
+        process(patient_mkB(env,samplers,resu,facilities))
+        t_out = samplers[0]() # samplers are rebuilt from conf by each run_for()
+        timeout(t_out).callbacks.append(arrive)
+    timeout(0).callbacks.append(arrive) # first patient at the start of the first run_for()
 
 # individual patient, keeps track of actual service times for each stage: required time and extra waiting
-def patient_mkB(env,conf,resu,facilities):
-    # minimum processing times for each stage, using config
-    e = random.expovariate
-    req_times = [e(1/conf['means'][1]),e(1/conf['means'][2]),e(1/conf['means'][3])]
-    
-    if (conf['unif'][1] != None):
-        req_times[0] = random.uniform(conf['unif'][1][0],conf['unif'][1][1])
-    if (conf['unif'][2] != None):
-        req_times[1] = random.uniform(conf['unif'][2][0],conf['unif'][2][1])
-    if (conf['unif'][3] != None):
-        req_times[2] = random.uniform(conf['unif'][3][0],conf['unif'][3][1])
-
-    flow_times = [env.now, 0, 0, 0, 0] # arrival times at each stage, including release
+def patient_mkB(env,samplers,resu,facilities):
+    # minimum processing times for each stage, all sampled here at arrival
+    _, prep_sample, op_sample, rec_sample = samplers
+    prep_t, op_t, rec_t = prep_sample(), op_sample(), rec_sample()
+    prep_res, op_res, rec_res = facilities # locals instead of list indexing at every stage
+    timeout = env.timeout
+    packed = resu['packed_counts'] # never swapped out mid-sim, unlike the other results, so safe to hold
+
+    now = env.now # read once per stage, right after the yield that advanced time
+    flow_times = [now, 0, 0, 0, 0] # arrival times at each stage, including release
     resu['patient_flow'].append(flow_times)
 
     # --- individual patient path through system ---
@@ -34,54 +95,64 @@ def patient_mkB(env,conf,resu,facilities):
     # * if it was logged at the end, active patients would not affect simulation results
     # * some error still remains, from not considering partial process completions at result calculation moment.
 
-    prep = facilities[0].request()
-    resu['patient_counts'][0] += 1
+    prep = prep_res.request()
+    packed[0] += COUNT_TOTAL
     yield prep # wait prep room
     flow_times[1] = env.now # patient taken to a prep room
-    resu['patient_counts'][1] += 1
+    packed[0] += COUNT_PREP
 
-    yield env.timeout(req_times[0])
-    op = facilities[1].request()
-    resu['util_active'][0] += req_times[0] # prep done, waiting op
+    yield timeout(prep_t)
+    op = op_res.request()
+    resu['util_active'][0] += prep_t # prep done, waiting op
     yield op
-    facilities[0].release(prep) # op room free, release prep
-    resu['patient_counts'][1] -= 1
-    resu['patient_counts'][2] += 1
-    flow_times[2] = env.now # patient enters operation
-    resu['total_active'][0] += flow_times[2] - flow_times[1] # op start - prep start = prep total
-
-    yield env.timeout(req_times[1])
-    rec = facilities[2].request()
+    now = env.now
+    prep_res.release(prep) # op room free, release prep
+    del prep # drop the request event now, not when the whole patient process ends
+    packed[0] += COUNT_PREP_TO_OP
+    flow_times[2] = now # patient enters operation
+    resu['total_active'][0] += now - flow_times[1] # op start - prep start = prep total
 
-    resu['util_active'][1] += req_times[1] # op done
+    yield timeout(op_t)
     block_start = env.now
+    rec = rec_res.request()
+    resu['util_active'][1] += op_t # op done
     yield rec
-    block_end = env.now
-    resu["or_time_blocked"]+= block_end - block_start # time waiting for rec bed
-    facilities[1].release(op) # op free once rec opens
-    resu['patient_counts'][2] -= 1
-    resu['patient_counts'][3] += 1
-    flow_times[3] = env.now # patient starts recovery
-    resu['total_active'][1] += flow_times[3] - flow_times[2] # op total
-
-    yield env.timeout(req_times[2])
-    facilities[2].release(rec) # rec done
-    resu['patient_counts'][3] -= 1
-    resu['patient_counts'][0] -= 1 # reduce total # of patients in system when rec is done
-    resu['util_active'][2] += req_times[2] # rec done
-    resu['total_active'][2] += req_times[2] # rec does not need to wait, so util% is always 100.
+    now = env.now
+    resu["or_time_blocked"] += now - block_start # time waiting for rec bed
+    op_res.release(op) # op free once rec opens
+    del op
+    packed[0] += COUNT_OP_TO_REC
+    flow_times[3] = now # patient starts recovery
+    resu['total_active'][1] += now - flow_times[2] # op total
+
+    yield timeout(rec_t)
+    rec_res.release(rec) # rec done
+    packed[0] += COUNT_LEAVE # out of rec, and reduce total # of patients in system when rec is done
+    resu['util_active'][2] += rec_t # rec done
+    resu['total_active'][2] += rec_t # rec does not need to wait, so util% is always 100.
     flow_times[4] = env.now # patient leaves
 
-# result monitor for things the patient doesnt track directly
+# result monitor for things the patient doesnt track directly.
+# same scheduled-callback form as the arrivals: each snapshot schedules the next one, no process to resume.
 def monitor_mkB(env,conf,resu,facilities):
-    while True:
+    prep_q, op_q, rec_q = [f.queue for f in facilities]
+    timeout = env.timeout
+    def snap(event):
+        # counts and queues as tuples: immutable, so a snapshot can not be changed through a shared reference later
         snapshot = {
             'time': env.now,
-            'patient_counts': copy.deepcopy(resu['patient_counts']), # totals in system at snapshot time
-            'queues': [len(facilities[0].queue), len(facilities[1].queue), len(facilities[2].queue)] # queues of each stage.
+            'patient_counts': unpack_counts(resu['packed_counts'][0]), # totals in system at snapshot time
+            'queues': (len(prep_q), len(op_q), len(rec_q)) # queues of each stage.
         }
         resu['snapshots'].append(snapshot)
-        yield env.timeout(conf['monitor_interval'])
+        timeout(conf['monitor_interval']).callbacks.append(snap)
+    timeout(0).callbacks.append(snap) # first snapshot at time 0, before the first patient
+
+# config check shared by both models: staffed facilities can not exceed the total of each type
+def check_staffing(conf):
+    for i in range(len(conf['total'])):
+        if (conf['staffed'][i] > conf['total'][i]):
+            raise ValueError('staffed %s facilities of type %d, total is %s' % (conf['staffed'][i], i, conf['total'][i]))
 
 class hospital_model:
 
@@ -92,44 +163,121 @@ class hospital_model:
         # simulation results
         self.results = {
             'patient_flow': [], # all flow times for each patient: arrival/prep/op/rec/leave
-            'patient_counts': [0,0,0,0], # patient count in: total/prep/op/rec
+            'patient_counts': [0,0,0,0], # patient count in: total/prep/op/rec, updated at the end of each run_for()
+            'packed_counts': [0], # live patient counts, see unpack_counts()
             'total_active': [0,0,0], # total time of prep/op/rec
             'util_active': [0,0,0], # active time of prep/op/rec
             'snapshots': [], # simulation situation at snapshot times, created by monitor process
             'or_time_blocked': 0
         }
 
-        # seed the rng
-        random.seed(a=conf['seed']) # doesnt need to check for None, seed() already does
+        # seeded rng streams for next/prep/op/rec, draws are pre-sampled in numpy batches
+        self.streams = random_streams(conf['seed']) # seed None gives fresh entropy, same as random.seed()
+        # draw functions of next/prep/op/rec, built from conf means/unif at the start of each run_for().
+        # filled in place, the processes hold this same list.
+        self.samplers = [None] * len(conf['means'])
 
-        # create limited resources
-        # + request all slack resources to remove them from the useable pool
+        # create limited resources, usable count is set from 'staffed' at the start of each run_for()
         self.facilities = []
-        self.slack_requests = []
         for i in range(0,len(conf['total'])):
-            self.facilities.append(simpy.Resource(self.env,capacity=conf['total'][i]))
-            facility_slack = []
-            self.slack_requests.append(facility_slack)
+            self.facilities.append(fast_resource(self.env,conf['staffed'][i]))
 
         # create always-on processes
-        self.env.process(monitor_mkB(self.env,conf,self.results,self.facilities))
-        self.env.process(patient_generator_mkB(self.env,conf,self.results,self.facilities))
+        # monitor is optional: patient counts can be rebuilt afterwards with counts_at(), only queues need snapshots
+        if (conf['monitor_interval'] != None):
+            monitor_mkB(self.env,conf,self.results,self.facilities)
+        patient_generator_mkB(self.env,self.samplers,self.results,self.facilities)
     
     # env run for time, also does config check for facilities
     def run_for(self, time):
         # refresh facilities according to config at start of time step:
+        check_staffing(self.conf)
         for i in range(len(self.conf['total'])): # loop each facility type.
-            prevlen = len(self.slack_requests[i])
-            newlen = self.conf['total'][i] - self.conf['staffed'][i]
-            # if more, add new
-            if (newlen > prevlen):
-                for j in range(newlen - prevlen):
-                    self.slack_requests[i].append(self.facilities[i].request())
-                    if (len(self.facilities[i].queue) > 0): # request did not go through immediately, move it to be first in prio
-                        self.facilities[i].queue.insert(0,self.facilities[i].queue.pop())
-            # if less, release
-            if (prevlen > newlen):
-                for j in range(prevlen - newlen):
-                    self.facilities[i].release(self.slack_requests[i].pop())
+            self.facilities[i].set_capacity(self.conf['staffed'][i])
+        self.samplers[:] = [rand.sampler(m, u) for rand, m, u in zip(self.streams, self.conf['means'], self.conf['unif'])]
         # continue simulation from current time:
         self.env.run(until= self.env.now + time)
+        self.results['patient_counts'][:] = unpack_counts(self.results['packed_counts'][0])
+
+    # drop results collected so far (e.g. warm-up), patients in flight keep going but are left out of the new results
+    def reset_results(self):
+        self.results['patient_flow'] = []
+        self.results['total_active'] = [0,0,0]
+        self.results['util_active'] = [0,0,0]
+        self.results['snapshots'] = []
+        self.results['or_time_blocked'] = 0
+
+    # patient_flow as one dense (patients, 5) float64 table, same layout as hospital_model_fast's patient_flow,
+    # e.g. table[:, 4] - table[:, 0] for time in system. 0 = stage not reached yet.
+    # the in-sim records stay lists: in-flight patients keep writing into their own record, and reset_results() detaches them.
+    def flow_table(self):
+        records = self.results['patient_flow']
+        width = len(FLOW_FIELDS)
+        # one pass into a preallocated buffer, cheaper than np.array() parsing the nested lists
+        flow = np.fromiter(itertools.chain.from_iterable(records), dtype=np.float64, count=len(records) * width)
+        return flow.reshape(-1, width)
+
+    # patient_flow as dense float64 columns (struct-of-arrays) for vectorized analysis, e.g. cols['leave'] - cols['arrival']
+    def flow_arrays(self):
+        cols = np.ascontiguousarray(self.flow_table().T) # one contiguous row per field
+        return {name: cols[i] for i, name in enumerate(FLOW_FIELDS)}
+
+    # monitor snapshots as numpy arrays for analysis: 'time' (M,), 'patient_counts' (M, 4) and 'queues' (M, 3)
+    def snapshot_arrays(self):
+        snaps = self.results['snapshots']
+        m = len(snaps)
+        chain = itertools.chain.from_iterable
+        return {
+            'time': np.fromiter((s['time'] for s in snaps), dtype=np.float64, count=m),
+            'patient_counts': np.fromiter(chain(s['patient_counts'] for s in snaps), dtype=np.int64, count=4 * m).reshape(m, 4),
+            'queues': np.fromiter(chain(s['queues'] for s in snaps), dtype=np.int64, count=3 * m).reshape(m, 3),
+        }
+
+    # patient counts total/prep/op/rec at given times, rebuilt from patient_flow event times instead of monitor snapshots.
+    # covers patients currently in patient_flow, so after a result reset the patients already in flight are not counted.
+    # 0 = stage not reached (same as patient_flow), so a stage entered at exactly time 0 is only seen once it is left.
+    def counts_at(self, times):
+        arrival, prep, op, rec, leave = self.flow_arrays().values()
+        times = np.asarray(times, dtype=np.float64)
+        def present(enter, exit, reached): # number of patients with enter <= t < exit
+            enter = np.sort(np.where(reached, enter, np.inf))
+            exit = np.sort(np.where(exit > 0, exit, np.inf))
+            return np.searchsorted(enter, times, 'right') - np.searchsorted(exit, times, 'right')
+        return np.stack([
+            present(arrival, leave, True),
+            present(prep, op, (prep > 0) | (op > 0)),
+            present(op, rec, (op > 0) | (rec > 0)),
+            present(rec, leave, (rec > 0) | (leave > 0)),
+        ], axis=1)
+
+# one replication: warm up, drop the warm-up results, then the actual run. module level so worker processes can run it.
+def _run_replication(conf, seed, time, warmup, fast=False):
+    conf = copy.deepcopy(conf) # prevent side effect on the caller's configuration
+    conf['seed'] = seed
+    if (fast):
+        from hospital_core import hospital_model_fast # imported here, hospital_core itself imports this module
+        return hospital_model_fast(conf).run(time)
+    hospital = hospital_model(conf)
+    if (warmup > 0):
+        hospital.run_for(warmup)
+        hospital.reset_results()
+    hospital.run_for(time)
+    return hospital.results
+
+# independent replications of the same config, one per seed, run in parallel worker processes.
+# returns the results dict of each replication, in seed order. workers=None uses all cores.
+# fast=True runs each replication with hospital_core.hospital_model_fast instead (no snapshots, no warm-up).
+def run_replications(conf, seeds, time, warmup=0, workers=None, fast=False):
+    if (fast and warmup > 0):
+        raise ValueError('warm-up is not supported by the fast model, it runs in a single shot')
+    seeds = list(seeds)
+    workers = workers or os.cpu_count() or 1
+    chunksize = max(1, len(seeds) // (4 * workers)) # several replications per task to amortize the ipc
+    with ProcessPoolExecutor(max_workers=workers) as ex:
+        return list(ex.map(_run_replication, itertools.repeat(conf), seeds,
+                           itertools.repeat(time), itertools.repeat(warmup), itertools.repeat(fast),
+                           chunksize=chunksize))
+
+# n well separated int seeds derived from one base seed, for run_replications()
+def replication_seeds(base, n):
+    return [int(s.generate_state(1)[0]) for s in np.random.SeedSequence(base).spawn(n)]